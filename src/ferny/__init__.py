@@ -8,7 +8,7 @@ from .interaction_agent import (
     temporary_askpass,
     write_askpass_to_tmpdir,
 )
-from .session import Session
+from .session import Session, SessionPool
 from .ssh_askpass import (
     AskpassPrompt,
     SshAskpassResponder,
@@ -41,6 +41,7 @@ __all__ = [
     'InteractionError',
     'InteractionHandler',
     'Session',
+    'SessionPool',
     'SshAskpassResponder',
     'SshAuthenticationError',
     'SshChangedHostKeyError',
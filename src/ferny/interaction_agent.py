@@ -19,21 +19,27 @@ import array
 import ast
 import asyncio
 import contextlib
+import functools
+import json
 import logging
 import os
 import re
 import socket
 import tempfile
-from typing import Any, Callable, ClassVar, Generator, Sequence
+from typing import Any, Callable, ClassVar, Coroutine, Generator, Sequence
 
 from . import interaction_client
 
 logger = logging.getLogger(__name__)
 
 
-COMMAND_RE = re.compile(b'\0ferny\0([^\n]*)\0\0\n')
+COMMAND_PREFIX = b'\0ferny\0'
+COMMAND_RE = re.compile(COMMAND_PREFIX + b'([^\n]*)\0\0\n')
 COMMAND_TEMPLATE = '\0ferny\0{(command, args)!r}\0\0\n'
 
+# ferny.end, as sent by interaction_client and BEIBOOT_GADGETS["end"]
+END_COMMAND_BLOBS = (b'["ferny.end", []]', b"('ferny.end', ())")
+
 BEIBOOT_GADGETS = {
     "command": fr"""
         import sys
@@ -52,28 +58,37 @@ class InteractionError(Exception):
     pass
 
 
-try:
-    recv_fds = socket.recv_fds
-except AttributeError:
-    # Python < 3.9
+# Room for the ancillary data of one message carrying up to 10 fds
+RECV_ANCBUFSIZE = socket.CMSG_LEN(10 * array.array('i').itemsize)
 
-    def recv_fds(
-        sock: socket.socket, bufsize: int, maxfds: int, flags: int = 0
-    ) -> 'tuple[bytes, list[int], int, None]':
-        fds = array.array("i")
-        msg, ancdata, flags, addr = sock.recvmsg(bufsize, socket.CMSG_LEN(maxfds * fds.itemsize))
-        for cmsg_level, cmsg_type, cmsg_data in ancdata:
-            if (cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS):
-                fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
-        return msg, list(fds), flags, addr
 
+def parse_command(command_blob: bytes) -> 'tuple[str, tuple[object, ...]]':
+    if command_blob in END_COMMAND_BLOBS:
+        # The message we see on every connection: no need to parse it
+        return 'ferny.end', ()
 
-def get_running_loop() -> asyncio.AbstractEventLoop:
-    try:
-        return asyncio.get_running_loop()
-    except AttributeError:
-        # Python 3.6
-        return asyncio.get_event_loop()
+    if command_blob.startswith(b'['):
+        # json.dumps([command, args]), as sent by our own interaction_client
+        command, args = json.loads(command_blob)
+        if isinstance(args, list):
+            args = tuple(args)
+    else:
+        # repr((command, args)), as sent via COMMAND_TEMPLATE
+        command, args = ast.literal_eval(command_blob.decode())
+
+    if not isinstance(command, str) or not isinstance(args, tuple):
+        raise TypeError('Invalid argument types')
+
+    return command, args
+
+
+try:
+    current_task = asyncio.current_task
+    get_running_loop = asyncio.get_running_loop
+except AttributeError:
+    # Python 3.6
+    current_task = asyncio.Task.current_task  # type:ignore[attr-defined]
+    get_running_loop = asyncio.get_event_loop
 
 
 class InteractionHandler:
@@ -142,49 +157,50 @@ class AskpassHandler(InteractionHandler):
             assert isinstance(argv, list)
             assert all(isinstance(arg, str) for arg in argv)
             assert isinstance(env, dict)
-            assert all(isinstance(key, str) and isinstance(val, str) for key, val in env.items())
+            # The only part of the environment that we use
+            assert isinstance(env.get('SSH_ASKPASS_PROMPT', ''), str)
             assert len(fds) == 2
         except (ValueError, TypeError, AssertionError) as exc:
             logger.error('Invalid arguments to askpass interaction: %s, %s: %s', args, fds, exc)
             return
 
-        with open(fds.pop(0), 'w') as status, open(fds.pop(0), 'w') as stdout:
-            try:
-                loop = get_running_loop()
-                try:
-                    task = asyncio.current_task()
-                except AttributeError:
-                    task = asyncio.Task.current_task()  # type:ignore[attr-defined] # (Python 3.6)
-                assert task is not None
-                loop.add_reader(status, task.cancel)
-
-                if len(argv) == 2:
-                    # normal askpass
-                    prompt = argv[1]
-                    hint = env.get('SSH_ASKPASS_PROMPT', '')
-                    logger.debug('do_askpass(%r, %r, %r)', stderr, prompt, hint)
-                    answer = await self.do_askpass(stderr, prompt, hint)
-                    logger.debug('do_askpass answer %r', answer)
-                    if answer is not None:
-                        print(answer, file=stdout)
-                        print(0, file=status)
-
-                elif len(argv) == 6:
-                    # KnownHostsCommand
-                    argv0, reason, host, algorithm, key, fingerprint = argv
-                    if reason in ['ADDRESS', 'HOSTNAME']:
-                        logger.debug('do_hostkey(%r, %r, %r, %r, %r)', reason, host, algorithm, key, fingerprint)
-                        if await self.do_hostkey(reason, host, algorithm, key, fingerprint):
-                            print(host, algorithm, key, file=stdout)
-                    else:
-                        logger.debug('ignoring KnownHostsCommand reason %r', reason)
-
-                    print(0, file=status)
-
+        # Single short writes: no need for file objects
+        status_fd, stdout_fd = fds.pop(0), fds.pop(0)
+        try:
+            loop = get_running_loop()
+            task = current_task()
+            assert task is not None
+            loop.add_reader(status_fd, task.cancel)
+
+            if len(argv) == 2:
+                # normal askpass
+                prompt = argv[1]
+                hint = env.get('SSH_ASKPASS_PROMPT', '')
+                logger.debug('do_askpass(%r, %r, %r)', stderr, prompt, hint)
+                answer = await self.do_askpass(stderr, prompt, hint)
+                logger.debug('do_askpass answer %r', answer)
+                if answer is not None:
+                    os.write(stdout_fd, f'{answer}\n'.encode())
+                    os.write(status_fd, b'0\n')
+
+            elif len(argv) == 6:
+                # KnownHostsCommand
+                argv0, reason, host, algorithm, key, fingerprint = argv
+                if reason in ['ADDRESS', 'HOSTNAME']:
+                    logger.debug('do_hostkey(%r, %r, %r, %r, %r)', reason, host, algorithm, key, fingerprint)
+                    if await self.do_hostkey(reason, host, algorithm, key, fingerprint):
+                        os.write(stdout_fd, f'{host} {algorithm} {key}\n'.encode())
                 else:
-                    logger.error('Incorrect number of command-line arguments to ferny-askpass: %s', argv)
-            finally:
-                loop.remove_reader(status)
+                    logger.debug('ignoring KnownHostsCommand reason %r', reason)
+
+                os.write(status_fd, b'0\n')
+
+            else:
+                logger.error('Incorrect number of command-line arguments to ferny-askpass: %s', argv)
+        finally:
+            loop.remove_reader(status_fd)
+            os.close(status_fd)
+            os.close(stdout_fd)
 
     async def run_command(self, command: str, args: 'tuple[object, ...]', fds: 'list[int]', stderr: str) -> None:
         logger.debug('run_command(%s, %s, %s, %s)', command, args, fds, stderr)
@@ -195,13 +211,22 @@ class AskpassHandler(InteractionHandler):
 
 
 class InteractionAgent:
-    _handlers: 'dict[str, InteractionHandler]'
+    # command name → bound run_command() method of the handler
+    _handlers: 'dict[str, Callable[[str, tuple[object, ...], list[int], str], Coroutine[Any, Any, None]]]'
 
     _loop: asyncio.AbstractEventLoop
 
     _tasks: 'set[asyncio.Task]'
 
+    # Unstructured stderr output is only kept up to this size.  When there's
+    # more, we drop the oldest data: the interesting part (ie: the error
+    # message) is at the end.
     _buffer: bytearray
+    _recv_buffer: bytearray
+    _buffer_limit: int = 256 * 1024
+    # Everything before this offset in _buffer is known not to contain the
+    # start of a "remote" message
+    _scan_offset: int = 0
     _ours: socket.socket
     _theirs: socket.socket
 
@@ -246,12 +271,10 @@ class InteractionAgent:
 
         self._consider_completion()
 
-    def _invoke_command(self, stderr: bytes, command_blob: bytes, fds: 'list[int]') -> None:
+    def _invoke_command(self, stderr: 'bytes | bytearray', command_blob: bytes, fds: 'list[int]') -> None:
         logger.debug('_invoke_command(%r, %r, %r)', stderr, command_blob, fds)
         try:
-            command, args = ast.literal_eval(command_blob.decode())
-            if not isinstance(command, str) or not isinstance(args, tuple):
-                raise TypeError('Invalid argument types')
+            command, args = parse_command(command_blob)
         except (UnicodeDecodeError, SyntaxError, ValueError, TypeError) as exc:
             logger.error('Received invalid ferny command: %s: %s', command_blob, exc)
             return
@@ -262,7 +285,7 @@ class InteractionAgent:
             return
 
         try:
-            handler = self._handlers[command]
+            run_command = self._handlers[command]
         except KeyError:
             logger.error('Received unhandled ferny command: %s', command)
             return
@@ -270,7 +293,7 @@ class InteractionAgent:
         # The task is responsible for the list of fds and removing itself
         # from the set.
         task_fds = list(fds)
-        task = self._loop.create_task(handler.run_command(command, args, task_fds, stderr.decode()))
+        task = self._loop.create_task(run_command(command, args, task_fds, stderr.decode(errors='replace')))
 
         def bottom_half(completed_task: asyncio.Task) -> None:
             assert completed_task is task
@@ -280,12 +303,12 @@ class InteractionAgent:
 
             try:
                 task.result()
-                logger.debug('%r completed cleanly', handler)
+                logger.debug('%r completed cleanly', run_command)
             except asyncio.CancelledError:
                 # this is not an error — it just means ferny-askpass exited via signal
-                logger.debug('%r was cancelled', handler)
+                logger.debug('%r was cancelled', run_command)
             except Exception as exc:
-                logger.debug('%r raised %r', handler, exc)
+                logger.debug('%r raised %r', run_command, exc)
                 self._result(exc)
 
             self._consider_completion()
@@ -294,8 +317,14 @@ class InteractionAgent:
         self._tasks.add(task)
         fds[:] = []
 
-    def _got_data(self, data: bytes, fds: 'list[int]') -> None:
-        logger.debug('_got_data(%r, %r)', data, fds)
+    def _trim_buffer(self) -> None:
+        excess = len(self._buffer) - self._buffer_limit
+        if excess > 0:
+            del self._buffer[:excess]
+            self._scan_offset = max(0, self._scan_offset - excess)
+
+    def _got_data(self, data: 'bytes | memoryview', fds: 'list[int]') -> None:
+        logger.debug('_got_data(%d bytes, %r)', len(data), fds)
 
         if data == b'':
             self._result(self._buffer.decode(errors='replace'))
@@ -303,34 +332,84 @@ class InteractionAgent:
 
         self._buffer.extend(data)
 
-        # Read zero or more "remote" messages
-        chunks = COMMAND_RE.split(self._buffer)
-        self._buffer = bytearray(chunks.pop())
-        while len(chunks) > 1:
-            self._invoke_command(chunks[0], chunks[1], [])
-            chunks = chunks[2:]
+        # Read zero or more "remote" messages.  Most reads don't contain any,
+        # so look for the literal prefix (in the new data only) before going
+        # to the regexp.
+        start = self._buffer.find(COMMAND_PREFIX, self._scan_offset)
+        if start != -1:
+            commands = []
+            end = 0
+            for match in COMMAND_RE.finditer(self._buffer, start):
+                commands.append((self._buffer[end:match.start()], match.group(1)))
+                end = match.end()
+
+            # Trim first: ferny.end completes with what follows the last message
+            del self._buffer[:end]
+            for stderr, command_blob in commands:
+                self._invoke_command(stderr, command_blob, [])
+            start = self._buffer.find(COMMAND_PREFIX, max(0, start - end))
+
+        # A prefix which is followed by a newline will never complete a
+        # message (or it would have matched above), so skip past it
+        while start != -1:
+            newline = self._buffer.find(b'\n', start)
+            if newline == -1:
+                break
+            start = self._buffer.find(COMMAND_PREFIX, newline + 1)
+
+        # Resume from an incomplete message, or from a prefix that might be
+        # split across reads
+        if start != -1:
+            self._scan_offset = start
+        else:
+            self._scan_offset = max(0, len(self._buffer) - len(COMMAND_PREFIX) + 1)
+        self._trim_buffer()
 
         # Maybe read one "local" message
         if fds:
             assert self._buffer.endswith(b'\0'), self._buffer
             stderr = self._buffer[:-1]
             self._buffer = bytearray(b'')
+            self._scan_offset = 0
             with open(fds.pop(0), 'rb') as command_channel:
                 command = command_channel.read()
             self._invoke_command(stderr, command, fds)
 
     def _read_ready(self) -> None:
-        try:
-            data, fds, _flags, _addr = recv_fds(self._ours, 4096, 10, flags=socket.MSG_DONTWAIT)
-        except BlockingIOError:
-            return
-        except OSError as exc:
-            self._result(exc)
-        else:
-            self._got_data(data, fds)
-        finally:
-            while fds:
-                os.close(fds.pop())
+        # Drain bursts of output without going back to the loop after every
+        # read, but don't monopolise it either
+        for _ in range(32):
+            if self._ours.fileno() == -1:
+                break  # _result() was called
+
+            fds: 'list[int]' = []
+            try:
+                # Receive directly into a reusable buffer: _got_data() copies
+                # whatever it needs to keep.
+                size, ancdata, _flags, _addr = self._ours.recvmsg_into(
+                    [self._recv_buffer], RECV_ANCBUFSIZE, socket.MSG_DONTWAIT
+                )
+                for cmsg_level, cmsg_type, cmsg_data in ancdata:
+                    if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+                        received = array.array('i')
+                        received.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % received.itemsize)])
+                        fds.extend(received)
+            except BlockingIOError:
+                break
+            except OSError as exc:
+                self._result(exc)
+            else:
+                n_tasks = len(self._tasks)
+                self._got_data(memoryview(self._recv_buffer)[:size], fds)
+
+                # A short read means that we've caught up.  Also, let newly
+                # started handlers run before reading further: if the next
+                # thing we read is EOF, it would cancel them.
+                if size < len(self._recv_buffer) or len(self._tasks) != n_tasks:
+                    break
+            finally:
+                while fds:
+                    os.close(fds.pop())
 
     def __init__(
         self,
@@ -345,13 +424,14 @@ class InteractionAgent:
 
         for handler in handlers:
             for command in handler.commands:
-                self._handlers[command] = handler
+                self._handlers[command] = handler.run_command
 
         if done_callback is not None:
             self._completion_future.add_done_callback(done_callback)
 
         self._theirs, self._ours = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
         self._buffer = bytearray()
+        self._recv_buffer = bytearray(4096)
 
     def fileno(self) -> int:
         return self._theirs.fileno()
@@ -382,6 +462,7 @@ class InteractionAgent:
                         if not data:
                             break
                         self._buffer.extend(data)
+                        self._trim_buffer()
         except OSError as exc:
             self._result(exc)
         else:
@@ -405,11 +486,17 @@ class InteractionAgent:
             raise InteractionError(stderr.strip())
 
 
+@functools.lru_cache()
+def get_askpass_data() -> bytes:
+    # The content never changes, so only go via the loader once
+    return __loader__.get_data(interaction_client.__file__)  # type: ignore
+
+
 def write_askpass_to_tmpdir(tmpdir: str) -> str:
     askpass_path = os.path.join(tmpdir, 'ferny-askpass')
     fd = os.open(askpass_path, os.O_CREAT | os.O_WRONLY | os.O_CLOEXEC | os.O_EXCL | os.O_NOFOLLOW, 0o777)
     try:
-        os.write(fd, __loader__.get_data(interaction_client.__file__))  # type: ignore
+        os.write(fd, get_askpass_data())
     finally:
         os.close(fd)
     return askpass_path
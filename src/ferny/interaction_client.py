@@ -2,6 +2,7 @@
 
 import array
 import io
+import json
 import os
 import socket
 import sys
@@ -9,15 +10,20 @@ from typing import Sequence
 
 
 def command(stderr_fd: int, command: str, *args: object, fds: Sequence[int] = ()) -> None:
-    cmd_read, cmd_write = [io.open(*end) for end in zip(os.pipe(), 'rw')]
+    cmd_read, cmd_write = [io.open(*end) for end in zip(os.pipe(), ('rb', 'wb'))]
 
     with cmd_write:
         with cmd_read:
-            with socket.fromfd(stderr_fd, socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            # Wrap stderr directly (rather than a dup() of it) and detach when done
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, fileno=stderr_fd)
+            try:
                 fd_array = array.array('i', (cmd_read.fileno(), *fds))
                 sock.sendmsg([b'\0'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fd_array)])
+            finally:
+                sock.detach()
 
-        cmd_write.write(repr((command, args)))
+        # json.dumps() escapes anything outside of ASCII
+        cmd_write.write(json.dumps([command, args]).encode('ascii'))
 
 
 def askpass(stderr_fd: int, stdout_fd: int, args: 'list[str]', env: 'dict[str, str]') -> int:
@@ -32,7 +38,7 @@ def askpass(stderr_fd: int, stdout_fd: int, args: 'list[str]', env: 'dict[str, s
 
 def main() -> None:
     if len(sys.argv) == 1:
-        command(2, 'ferny.end', [])
+        command(2, 'ferny.end')
     else:
         sys.exit(askpass(2, 1, sys.argv, dict(os.environ)))
 
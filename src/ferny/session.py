@@ -24,12 +24,11 @@ import shlex
 import signal
 import subprocess
 import tempfile
-from typing import Mapping, Sequence
+from typing import Callable, Hashable, Mapping, Sequence
 
 from . import ssh_errors
 from .interaction_agent import InteractionAgent, InteractionError, InteractionHandler, write_askpass_to_tmpdir
 
-prctl = ctypes.cdll.LoadLibrary('libc.so.6').prctl
 logger = logging.getLogger(__name__)
 PR_SET_PDEATHSIG = 1
 
@@ -43,6 +42,35 @@ def has_feature(feature: str, teststr: str = 'x') -> bool:
         return False
 
 
+_has_setpriv_pdeathsig: 'bool | None' = None
+
+
+async def has_setpriv_pdeathsig() -> bool:
+    # util-linux setpriv gained --pdeathsig in 2.33.  Probe once per process,
+    # without blocking the main loop.
+    global _has_setpriv_pdeathsig
+    if _has_setpriv_pdeathsig is None:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                '/usr/bin/setpriv', '--pdeathsig=KILL', '--', 'true',
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            _has_setpriv_pdeathsig = await process.wait() == 0
+        except OSError:
+            _has_setpriv_pdeathsig = False
+    return _has_setpriv_pdeathsig
+
+
+@functools.lru_cache()
+def get_prctl() -> Callable[..., int]:
+    # Only needed if we have no setpriv.  libc is already loaded, so look it
+    # up in our own process instead of dlopen()ing it by name.  We only ever
+    # pass the option and one argument.
+    prctl = ctypes.CDLL(None, use_errno=True).prctl
+    prctl.argtypes = (ctypes.c_int, ctypes.c_ulong)
+    prctl.restype = ctypes.c_int
+    return prctl
+
+
 class SubprocessContext:
     def wrap_subprocess_args(self, args: Sequence[str]) -> Sequence[str]:
         """Return the args required to launch a process in the given context.
@@ -123,8 +151,9 @@ class Session(SubprocessContext, InteractionHandler):
             args.append(f'-i{identity_file}')
 
         if options is not None:
-            for key in options:  # Note: Mapping may not have .items()
-                args.append(f'-o{key} {options[key]}')
+            # Note: Mapping may not have .items()
+            for key in options:
+                args.extend(('-o', f'{key}={options[key]}'))
 
         if pkcs11 is not None:
             args.append(f'-I{pkcs11}')
@@ -143,18 +172,30 @@ class Session(SubprocessContext, InteractionHandler):
 
         agent = InteractionAgent([interaction_responder] if interaction_responder is not None else [])
 
+        # We want ssh to die with us.  If possible, have setpriv arrange that
+        # before it execs ssh: a preexec_fn forces subprocess to fork() and
+        # run Python code in the child, which rules out using vfork() (on
+        # Python 3.10 and later).  posix_spawn() is out either way, because of
+        # start_new_session.
+        if await has_setpriv_pdeathsig():
+            argv = ['/usr/bin/setpriv', '--pdeathsig=KILL', '--', '/usr/bin/ssh', *args, destination]
+            preexec_fn = None
+        else:
+            argv = ['/usr/bin/ssh', *args, destination]
+            # Look this up now: we shouldn't dlopen() after fork()
+            preexec_fn = functools.partial(get_prctl(), PR_SET_PDEATHSIG, signal.SIGKILL)
+
         # SSH_ASKPASS_REQUIRE is not generally available, so use setsid
         process = await asyncio.create_subprocess_exec(
-            *('/usr/bin/ssh', *args, destination), env=env,
+            *argv, env=env,
             start_new_session=True, stdin=asyncio.subprocess.DEVNULL,
             stdout=asyncio.subprocess.DEVNULL, stderr=agent,  # type: ignore
-            preexec_fn=lambda: prctl(PR_SET_PDEATHSIG, signal.SIGKILL))
+            preexec_fn=preexec_fn)
 
         # This is tricky: we need to clean up the subprocess, but only in case
         # if failure.  Otherwise, we keep it around.
         try:
             await agent.communicate()
-            assert os.path.exists(self._controlsock)
             self._process = process
         except InteractionError as exc:
             await process.wait()
@@ -163,17 +204,34 @@ class Session(SubprocessContext, InteractionHandler):
             # If we get here because the InteractionHandler raised an
             # exception then SSH might still be running, and may even attempt
             # further interactions (ie: 2nd attempt for password).  We already
-            # have our exception and don't need any more info.  Kill it.
+            # have our exception and don't need any more info.  Stop it, but
+            # give it a moment to exit cleanly (and remove its control
+            # socket) before resorting to SIGKILL.  Do that even if we get
+            # cancelled (again) while we wait.
             try:
-                process.kill()
+                process.terminate()
             except ProcessLookupError:
                 pass  # already exited?  good.
-            await process.wait()
+            try:
+                await asyncio.wait_for(process.wait(), 0.1)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if process.returncode is None:
+                    try:
+                        process.kill()
+                    except ProcessLookupError:
+                        pass
+                    await process.wait()
             raise
 
     def is_connected(self) -> bool:
         return self._process is not None
 
+    def is_running(self) -> bool:
+        # The master can exit at any time (network trouble, remote reboot...)
+        return self._process is not None and self._process.returncode is None
+
     async def wait(self) -> None:
         assert self._process is not None
         await self._process.wait()
@@ -196,3 +254,92 @@ class Session(SubprocessContext, InteractionHandler):
         # 2. We need to quote the arguments — ssh will paste them together
         #    using only spaces, executing the result using the user's shell.
         return ('ssh', '-S', self._controlsock, '', *map(shlex.quote, args))
+
+
+class SessionPool:
+    """A pool of connected Sessions, shared between users with equal parameters.
+
+    acquire() takes the same arguments as Session.connect() and returns a
+    connected Session, reusing an existing one if it was connected with the
+    same parameters.  Each call to acquire() must be paired with a call to
+    release().  The Session gets disconnected when its last user releases it.
+
+    The interaction_responder is only used when a new connection is made.
+    That includes replacing a pooled Session whose connection has died.
+    """
+    _locks: 'dict[Hashable, asyncio.Lock]'
+    _refs: 'dict[Hashable, int]'
+    _sessions: 'dict[Hashable, Session]'
+    _keys: 'dict[Session, Hashable]'
+    _users: 'dict[Session, int]'
+
+    def __init__(self) -> None:
+        self._locks = {}
+        self._refs = {}
+        self._sessions = {}
+        self._keys = {}
+        self._users = {}
+
+    def _unref(self, key: Hashable) -> None:
+        # Each pending acquire() and each acquired Session holds a reference
+        # to the lock for its key.  Drop the lock along with the last one.
+        self._refs[key] -= 1
+        if self._refs[key] == 0:
+            del self._refs[key]
+            del self._locks[key]
+
+    async def acquire(self,
+                      destination: str,
+                      handle_host_key: bool = False,
+                      configfile: 'str | None' = None,
+                      identity_file: 'str | None' = None,
+                      login_name: 'str | None' = None,
+                      options: 'Mapping[str, str] | None' = None,
+                      pkcs11: 'str | None' = None,
+                      port: 'int | None' = None,
+                      interaction_responder: 'InteractionHandler | None' = None) -> Session:
+        # Note: Mapping may not have .items()
+        option_items = tuple(sorted((key, options[key]) for key in options)) if options is not None else None
+        key = (destination, handle_host_key, configfile, identity_file, login_name, option_items, pkcs11, port)
+
+        if key not in self._locks:
+            self._locks[key] = asyncio.Lock()
+        self._refs[key] = self._refs.get(key, 0) + 1
+
+        try:
+            # Make sure that concurrent callers wait for a single connection attempt
+            async with self._locks[key]:
+                session = self._sessions.get(key)
+
+                if session is not None and not session.is_running():
+                    # Current users keep it until they release it, but it's no
+                    # longer handed out
+                    del self._sessions[key]
+                    session = None
+
+                if session is None:
+                    session = Session()
+                    await session.connect(destination, handle_host_key=handle_host_key, configfile=configfile,
+                                          identity_file=identity_file, login_name=login_name, options=options,
+                                          pkcs11=pkcs11, port=port, interaction_responder=interaction_responder)
+                    self._sessions[key] = session
+                    self._keys[session] = key
+                    self._users[session] = 0
+
+                self._users[session] += 1
+                return session
+        except BaseException:
+            self._unref(key)
+            raise
+
+    async def release(self, session: Session) -> None:
+        key = self._keys[session]
+        self._unref(key)
+        self._users[session] -= 1
+        if self._users[session] == 0:
+            del self._keys[session]
+            del self._users[session]
+            if self._sessions.get(key) is session:
+                del self._sessions[key]
+            if session.is_running():
+                await session.disconnect()
@@ -1,6 +1,6 @@
 import logging
 import re
-from typing import ClassVar, Match, Sequence
+from typing import ClassVar, Match, Pattern, Sequence
 
 from .interaction_agent import AskpassHandler
 
@@ -43,6 +43,24 @@ class AskpassPrompt:
         return await responder.do_prompt(self)
 
 
+HELPERS = {
+    "%{algorithm}": r"(?P<algorithm>\b[-\w]+\b)",
+    "%{filename}": r"(?P<filename>.+)",
+    "%{fingerprint}": r"(?P<fingerprint>SHA256:[0-9A-Za-z+/]{43})",
+    "%{hostname}": r"(?P<hostname>[^ @']+)",
+    "%{pkcs11_id}": r"(?P<pkcs11_id>.+)",
+    "%{username}": r"(?P<username>[^ @']+)",
+}
+
+
+def with_helpers(pattern: str) -> str:
+    for name, helper in HELPERS.items():
+        pattern = pattern.replace(name, helper)
+
+    assert '%{' not in pattern
+    return pattern
+
+
 class SSHAskpassPrompt(AskpassPrompt):
     # The valid answers to prompts of this type.  If this is None then any
     # answer is permitted.  If it's a sequence then only answers from the
@@ -55,27 +73,30 @@ class SSHAskpassPrompt(AskpassPrompt):
     # `_extra_patterns` can fill in extra class attributes if they match.
     _extra_patterns: ClassVar[Sequence[str]] = ()
 
+    # The above, compiled once for each subclass
+    _compiled_pattern: ClassVar[Pattern]
+    _compiled_extra_patterns: ClassVar[Sequence[Pattern]]
+
+    def __init_subclass__(cls) -> None:
+        super().__init_subclass__()
+        if hasattr(cls, '_pattern'):
+            cls._compiled_pattern = re.compile(with_helpers(cls._pattern))
+            cls._compiled_extra_patterns = tuple(re.compile(with_helpers(p), re.M) for p in cls._extra_patterns)
+
     def __init__(self, prompt: str, messages: str, stderr: str, match: Match) -> None:
         super().__init__(prompt, messages, stderr)
         self.__dict__.update(match.groupdict())
 
-        for pattern in self._extra_patterns:
-            extra_match = re.search(with_helpers(pattern), messages, re.M)
+        if not messages:
+            return  # nothing for the extra patterns to find
+
+        for pattern in self._compiled_extra_patterns:
+            extra_match = pattern.search(messages)
             if extra_match is not None:
                 self.__dict__.update(extra_match.groupdict())
 
 
 # Specific prompts
-HELPERS = {
-    "%{algorithm}": r"(?P<algorithm>\b[-\w]+\b)",
-    "%{filename}": r"(?P<filename>.+)",
-    "%{fingerprint}": r"(?P<fingerprint>SHA256:[0-9A-Za-z+/]{43})",
-    "%{hostname}": r"(?P<hostname>[^ @']+)",
-    "%{pkcs11_id}": r"(?P<pkcs11_id>.+)",
-    "%{username}": r"(?P<username>[^ @']+)",
-}
-
-
 class SshPasswordPrompt(SSHAskpassPrompt):
     _pattern = r"%{username}@%{hostname}'s password: "
     username: 'str | None' = None
@@ -135,24 +156,17 @@ class SshHostKeyPrompt(SSHAskpassPrompt):
         return await responder.do_host_key_prompt(self)
 
 
-def with_helpers(pattern: str) -> str:
-    for name, helper in HELPERS.items():
-        pattern = pattern.replace(name, helper)
-
-    assert '%{' not in pattern
-    return pattern
+PROMPT_CLASSES = (
+    SshFIDOPINPrompt,
+    SshFIDOUserPresencePrompt,
+    SshHostKeyPrompt,
+    SshPKCS11PINPrompt,
+    SshPassphrasePrompt,
+    SshPasswordPrompt,
+)
 
 
 def categorize_ssh_prompt(string: str, stderr: str) -> AskpassPrompt:
-    classes = [
-        SshFIDOPINPrompt,
-        SshFIDOUserPresencePrompt,
-        SshHostKeyPrompt,
-        SshPKCS11PINPrompt,
-        SshPassphrasePrompt,
-        SshPasswordPrompt,
-    ]
-
     # The last line is the line after the last newline character, excluding the
     # optional final newline character.  eg: "x\ny\nLAST\n" or "x\ny\nLAST"
     second_last_newline = string.rfind('\n', 0, -1)
@@ -163,9 +177,8 @@ def categorize_ssh_prompt(string: str, stderr: str) -> AskpassPrompt:
         last_line = string
         extras = ''
 
-    for cls in classes:
-        pattern = with_helpers(cls._pattern)
-        match = re.fullmatch(pattern, last_line)
+    for cls in PROMPT_CLASSES:
+        match = cls._compiled_pattern.fullmatch(last_line)
         if match is not None:
             return cls(last_line, extras, stderr, match)
 
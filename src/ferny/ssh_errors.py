@@ -25,6 +25,8 @@ from typing import ClassVar, Iterable, Match, Pattern
 
 class SshError(Exception):
     PATTERN: ClassVar[Pattern]
+    # A lowercase substring of anything that PATTERN can match
+    NEEDLE: ClassVar[str]
 
     def __init__(self, match: 'Match | None', stderr: str) -> None:
         super().__init__(match.group(0) if match is not None else stderr)
@@ -33,6 +35,7 @@ class SshError(Exception):
 
 class SshAuthenticationError(SshError):
     PATTERN = re.compile(r'^([^:]+): Permission denied \(([^()]+)\)\.$', re.M)
+    NEEDLE = 'permission denied'
 
     def __init__(self, match: Match, stderr: str) -> None:
         super().__init__(match, stderr)
@@ -43,20 +46,24 @@ class SshAuthenticationError(SshError):
 
 class SshInvalidHostnameError(SshError):
     PATTERN = re.compile(r'^hostname contains invalid characters', re.I)
+    NEEDLE = 'hostname contains invalid characters'
 
 
 # generic host key error for OSes without KnownHostsCommand support
 class SshHostKeyError(SshError):
     PATTERN = re.compile(r'^Host key verification failed.$', re.M)
+    NEEDLE = 'host key verification failed'
 
 
 # specific errors for OSes with KnownHostsCommand
 class SshUnknownHostKeyError(SshHostKeyError):
     PATTERN = re.compile(r'^No .* host key is known.*Host key verification failed.$', re.S | re.M)
+    NEEDLE = 'host key is known'
 
 
 class SshChangedHostKeyError(SshHostKeyError):
     PATTERN = re.compile(r'warning.*remote host identification has changed', re.I)
+    NEEDLE = 'remote host identification has changed'
 
 
 # Functionality for mapping getaddrinfo()-family error messages to their
@@ -74,6 +81,20 @@ def make_gaierror_map() -> 'Iterable[tuple[str, int]]':
 gaierror_map = dict(make_gaierror_map())
 
 
+# Functionality for mapping strerror() error messages back to their errno.
+def make_strerror_map() -> 'dict[str, int]':
+    strerror_map: 'dict[str, int]' = {}
+
+    for errnum in errno.errorcode:
+        # if two errnos share a message, the first one wins
+        strerror_map.setdefault(os.strerror(errnum), errnum)
+
+    return strerror_map
+
+
+strerror_map = make_strerror_map()
+
+
 # Functionality for passing strerror() error messages to their equivalent
 # Python exceptions.
 # There doesn't seem to be an official API for turning an errno into the
@@ -106,9 +127,14 @@ oserror_subclass_map = dict((errnum, cls) for cls, errnum in [
 def get_exception_for_ssh_stderr(stderr: str) -> Exception:
     stderr = stderr.replace('\r\n', '\n')  # fix line separators
 
+    # avoid running the regexps over (possibly long) output that can't match
+    folded = stderr.lower()
+
     # check for the specific error messages first, then for generic SshHostKeyError
     for ssh_cls in [SshInvalidHostnameError, SshAuthenticationError,
                     SshChangedHostKeyError, SshUnknownHostKeyError, SshHostKeyError]:
+        if ssh_cls.NEEDLE not in folded:
+            continue
         match = ssh_cls.PATTERN.search(stderr)
         if match is not None:
             return ssh_cls(match, stderr)
@@ -123,10 +149,10 @@ def get_exception_for_ssh_stderr(stderr: str) -> Exception:
             return socket.gaierror(errnum, stderr)
 
         # Network connect errors
-        for errnum in errno.errorcode:
-            if os.strerror(errnum) == potential_strerror:
-                os_cls = oserror_subclass_map.get(errnum, OSError)
-                return os_cls(errnum, stderr)
+        if potential_strerror in strerror_map:
+            errnum = strerror_map[potential_strerror]
+            os_cls = oserror_subclass_map.get(errnum, OSError)
+            return os_cls(errnum, stderr)
 
     # No match?  Generic.
     return SshError(None, stderr)
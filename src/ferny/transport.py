@@ -16,7 +16,6 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
-import contextlib
 import logging
 import typing
 from typing import Any, Callable, Iterable, Sequence, TypeVar
@@ -30,6 +29,8 @@ P = TypeVar('P', bound=asyncio.Protocol)
 
 
 class SubprocessError(Exception):
+    __slots__ = ('returncode', 'stderr')
+
     returncode: int
     stderr: str
 
@@ -40,26 +41,37 @@ class SubprocessError(Exception):
 
 
 class FernyTransport(asyncio.Transport, asyncio.SubprocessProtocol):
+    # Defaults are set in __init__(), since slots can't have class defaults.
+    # asyncio's base classes only declare __slots__ since Python 3.8: before
+    # that, instances get a __dict__ (and __weakref__) from them anyway.
+    # After, they have no __dict__, but should still be weakly referenceable.
+    __slots__ = (
+        '_agent', '_exec_task', '_is_ssh', '_protocol', '_protocol_disconnected',
+        '_subprocess_transport', '_stdin_transport', '_stdout_transport',
+        '_exception', '_stderr_output', '_returncode', '_transport_disconnected', '_closed',
+    ) + (() if hasattr(asyncio.Transport, '__weakref__') or hasattr(asyncio.SubprocessProtocol, '__weakref__')
+         else ('__weakref__',))
+
     _agent: InteractionAgent
-    _exec_task: 'asyncio.Task[tuple[asyncio.SubprocessTransport, FernyTransport]]'
+    _exec_task: 'asyncio.Task[None]'
     _is_ssh: bool
     _protocol: asyncio.Protocol
-    _protocol_disconnected: bool = False
+    _protocol_disconnected: bool
 
     # These get initialized in connection_made() and once set, never get unset.
-    _subprocess_transport: 'asyncio.SubprocessTransport | None' = None
-    _stdin_transport: 'asyncio.WriteTransport | None' = None
-    _stdout_transport: 'asyncio.ReadTransport | None' = None
+    _subprocess_transport: 'asyncio.SubprocessTransport | None'
+    _stdin_transport: 'asyncio.WriteTransport | None'
+    _stdout_transport: 'asyncio.ReadTransport | None'
 
     # We record events that might build towards a connection termination here
     # and consider them from _consider_disconnect() in order to try to get the
     # best possible Exception for the protocol, rather than just taking the
     # first one (which is likely to be somewhat random).
-    _exception: 'Exception | None' = None
-    _stderr_output: 'str | None' = None
-    _returncode: 'int | None' = None
-    _transport_disconnected: bool = False
-    _closed: bool = False
+    _exception: 'Exception | None'
+    _stderr_output: 'str | None'
+    _returncode: 'int | None'
+    _transport_disconnected: bool
+    _closed: bool
 
     @classmethod
     def spawn(
@@ -130,23 +142,20 @@ class FernyTransport(asyncio.Transport, asyncio.SubprocessProtocol):
         # subprocess module, which blocks while waiting for the exec() to
         # complete in the child), but we have to deal with the complication of
         # the async interface anyway.  Since we, ourselves, want to export a
-        # non-async interface, that means that we need a task here and a
-        # bottom-half handler below.
-        self._exec_task = loop.create_task(loop.subprocess_exec(lambda: self, *args, **kwargs))
-
-        def exec_completed(task: asyncio.Task) -> None:
-            logger.debug('exec_completed(%r, %r)', self, task)
-            assert task is self._exec_task
+        # non-async interface, that means that we need a task here.  The
+        # follow-up work happens in the same task, as soon as the exec is done.
+        async def exec_and_start() -> None:
+            logger.debug('exec_and_start(%r)', self)
             try:
-                transport, me = task.result()
+                transport, me = await loop.subprocess_exec(lambda: self, *args, **kwargs)
                 assert me is self
                 logger.debug('  success.')
-            except asyncio.CancelledError:
-                return  # in that case, do nothing
             except OSError as exc:
                 logger.debug('  OSError %r', exc)
-                self.close(exc)
+                # Not close(): it would cancel this task, and we're done anyway
+                self._close(exc)
                 return
+            # If we get cancelled, we just let that happen
 
             # Our own .connection_made() handler should have gotten called by
             # now.  Make sure everything got filled in properly.
@@ -157,12 +166,21 @@ class FernyTransport(asyncio.Transport, asyncio.SubprocessProtocol):
             # Ask the InteractionAgent to start processing stderr.
             self._agent.start()
 
-        self._exec_task.add_done_callback(exec_completed)
+        self._exec_task = loop.create_task(exec_and_start())
 
         return self, protocol
 
     def __init__(self, protocol: asyncio.Protocol) -> None:
         self._protocol = protocol
+        self._protocol_disconnected = False
+        self._subprocess_transport = None
+        self._stdin_transport = None
+        self._stdout_transport = None
+        self._exception = None
+        self._stderr_output = None
+        self._returncode = None
+        self._transport_disconnected = False
+        self._closed = False
 
     def _consider_disconnect(self) -> None:
         logger.debug('_consider_disconnect(%r)', self)
@@ -249,7 +267,9 @@ class FernyTransport(asyncio.Transport, asyncio.SubprocessProtocol):
 
     # SubprocessProtocol implementation
     def pipe_data_received(self, fd: int, data: bytes) -> None:
-        logger.debug('pipe_data_received(%r, %r, %r)', self, fd, len(data))
+        # This runs for every read, so skip even building the arguments
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('pipe_data_received(%r, %r, %r)', self, fd, len(data))
         assert fd == 1  # stderr is handled separately
         self._protocol.data_received(data)
 
@@ -287,18 +307,25 @@ class FernyTransport(asyncio.Transport, asyncio.SubprocessProtocol):
     # Transport implementation.  Most of this is straight delegation.
     def close(self, exc: 'Exception | None' = None) -> None:
         logger.debug('close(%r, %r)', self, exc)
+        if not self._exec_task.done():
+            logger.debug('  cancelling _exec_task')
+            self._exec_task.cancel()
+        self._close(exc)
+
+    def _close(self, exc: 'Exception | None') -> None:
+        # Everything close() does, except for cancelling _exec_task, which
+        # calls this directly if the exec fails
         self._closed = True
         if self._exception is None:
             logger.debug('  setting exception %r', exc)
             self._exception = exc
-        if not self._exec_task.done():
-            logger.debug('  cancelling _exec_task')
-            self._exec_task.cancel()
         if self._subprocess_transport is not None:
             logger.debug('  closing _subprocess_transport')
             # https://github.com/python/cpython/issues/112800
-            with contextlib.suppress(PermissionError):
+            try:
                 self._subprocess_transport.close()
+            except PermissionError:
+                pass
         self._agent.force_completion()
 
     def is_closing(self) -> bool:
@@ -6,6 +6,8 @@ import pytest
 
 import ferny
 
+ASKPASS_ENV = dict(os.environ, PYTHONPATH=':'.join(sys.path))
+
 
 class SpeakSlow(ferny.SshAskpassResponder):
     running = False
@@ -48,7 +50,7 @@ async def test_cancel_askpass(event_loop: asyncio.AbstractEventLoop) -> None:
         stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.PIPE,
         stderr=agent.fileno(),
-        env=dict(os.environ, PYTHONPATH=':'.join(sys.path)))
+        env=ASKPASS_ENV)
 
     with pytest.raises(ferny.InteractionError) as raises:
         await agent.communicate()
@@ -73,7 +75,7 @@ async def test_cancel_agent_during_interaction(event_loop: asyncio.AbstractEvent
         stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.PIPE,
         stderr=agent.fileno(),
-        env=dict(os.environ, PYTHONPATH=':'.join(sys.path)))
+        env=ASKPASS_ENV)
 
     # Communicate in a task
     communicate_task = event_loop.create_task(agent.communicate())
@@ -105,7 +107,7 @@ async def test_cancel_agent_on_init(event_loop: asyncio.AbstractEventLoop) -> No
         stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.PIPE,
         stderr=agent.fileno(),
-        env=dict(os.environ, PYTHONPATH=':'.join(sys.path)))
+        env=ASKPASS_ENV)
 
     # Communicate in a task
     communicate_task = event_loop.create_task(agent.communicate())
@@ -137,7 +139,7 @@ async def test_cancel_before_interaction(event_loop: asyncio.AbstractEventLoop)
         stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.PIPE,
         stderr=agent.fileno(),
-        env=dict(os.environ, PYTHONPATH=':'.join(sys.path)))
+        env=ASKPASS_ENV)
 
     # Communicate in a task
     communicate_task = event_loop.create_task(agent.communicate())
@@ -193,8 +195,108 @@ async def test_command_template() -> None:
             "args = (1, 2, 3)",
             f"sys.stderr.write(f{ferny.COMMAND_TEMPLATE!r})"
         ]), stderr=agent.fileno(),
-        env=dict(os.environ, PYTHONPATH=':'.join(sys.path)))
+        env=ASKPASS_ENV)
     with pytest.raises(ValueError) as raises:
         await agent.communicate()
     assert raises.value.args == ('bzzt', (1, 2, 3), [], '')
     await process.wait()
+
+
+@pytest.mark.asyncio
+async def test_command_binary_stderr() -> None:
+    agent = ferny.InteractionAgent([RaiseResponder()])
+    process = await asyncio.create_subprocess_exec(
+        'python3', '-c', '; '.join([
+            "import sys, time",
+            "command = 'bzzt'",
+            "args = ()",
+            "sys.stderr.buffer.write(b'\\xff\\n')",
+            f"sys.stderr.write(f{ferny.COMMAND_TEMPLATE!r})",
+            "sys.stderr.flush()",
+            "time.sleep(60)"  # stay around, so EOF doesn't race the handler
+        ]), stderr=agent.fileno())
+    with pytest.raises(ValueError) as raises:
+        await agent.communicate()
+    assert raises.value.args == ('bzzt', (), [], '\ufffd\n')
+    process.kill()
+    await process.wait()
+
+
+@pytest.mark.asyncio
+async def test_command_split() -> None:
+    # the message arrives one byte at a time, after some noise
+    agent = ferny.InteractionAgent([RaiseResponder()])
+    process = await asyncio.create_subprocess_exec(
+        'python3', '-c', '; '.join([
+            "import sys, time",
+            "command = 'bzzt'",
+            "args = (1, 2, 3)",
+            "sys.stderr.write('noise\\0ferny\\0\\n')",
+            f"message = f{ferny.COMMAND_TEMPLATE!r}",
+            "[(sys.stderr.write(c), sys.stderr.flush(), time.sleep(0.001)) for c in message]",
+            "time.sleep(60)"  # stay around, so EOF doesn't race the handler
+        ]), stderr=agent.fileno())
+    with pytest.raises(ValueError) as raises:
+        await agent.communicate()
+    assert raises.value.args == ('bzzt', (1, 2, 3), [], 'noise\0ferny\0\n')
+    process.kill()
+    await process.wait()
+
+
+@pytest.mark.parametrize('blob', [
+    b'["bzzt", [1, "2", [3]]]',     # interaction_client (JSON)
+    b"('bzzt', (1, '2', [3]))",     # COMMAND_TEMPLATE (repr)
+])
+def test_parse_command(blob: bytes) -> None:
+    assert ferny.interaction_agent.parse_command(blob) == ('bzzt', (1, '2', [3]))
+
+
+@pytest.mark.parametrize('blob', ferny.interaction_agent.END_COMMAND_BLOBS)
+def test_end_command_blobs(blob: bytes) -> None:
+    assert ferny.interaction_agent.parse_command(blob) == ('ferny.end', ())
+    # make sure the fast path agrees with the parser
+    assert ferny.interaction_agent.parse_command(blob + b' ') == ('ferny.end', ())
+
+
+@pytest.mark.parametrize('blob', [b'["bzzt"]', b'[1, []]', b"('bzzt', [])", b'{}', b'(bzzt'])
+def test_parse_invalid_command(blob: bytes) -> None:
+    with pytest.raises((SyntaxError, ValueError, TypeError)):
+        ferny.interaction_agent.parse_command(blob)
+
+
+@pytest.mark.asyncio
+async def test_stderr_limit() -> None:
+    agent = ferny.InteractionAgent([])
+    process = await asyncio.create_subprocess_shell(
+        r'''
+            # a lot of noise, followed by the actual error
+            head -c 1000000 /dev/zero | tr '\0' 'x' >&2
+            echo >&2
+            echo 'the real error' >&2
+        ''',
+        stderr=agent.fileno())
+
+    with pytest.raises(ferny.InteractionError) as raises:
+        await agent.communicate()
+    message, = raises.value.args
+    assert message.endswith('x\nthe real error')
+    assert len(message) < 1000000
+
+    await process.wait()
+
+
+@pytest.mark.asyncio
+async def test_unterminated_prefix() -> None:
+    # a prefix followed by a newline can't start a message, so we shouldn't
+    # keep scanning from it as more data arrives
+    agent = ferny.InteractionAgent([])
+    agent._got_data(b'noise\0ferny\0\nmore', [])
+    assert agent._scan_offset > len(b'noise')
+    agent._got_data(b'x' * 100000, [])
+    assert agent._scan_offset > 100000
+    agent._got_data(b'', [])
+
+    with pytest.raises(ferny.InteractionError) as raises:
+        await agent.communicate()
+    message, = raises.value.args
+    assert message == 'noise\0ferny\0\nmore' + 'x' * 100000
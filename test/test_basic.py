@@ -314,3 +314,57 @@ class TestBasic:
     ) -> None:
         monkeypatch.setenv('BLABBERMOUTH', 'bla' * 10000)
         await self.run_test(key_dir, runtime_dir, True, 'passphrase')
+
+    @pytest.mark.asyncio
+    async def test_session_pool(self, key_dir: pathlib.Path, runtime_dir: pathlib.Path) -> None:
+        responder = MockResponder(ZeroDivisionError(), 'passphrase')
+        known_hosts = key_dir / 'known_hosts'
+        pool = ferny.SessionPool()
+
+        async with await ssh_server() as server:
+            host, port = server.sockets[0].getsockname()
+            hostkey = (key_dir / 'hostkey_ed25519.pub').read_text()
+            known_hosts.write_text(f'[{host}]:{port} {hostkey}\n')
+
+            async def acquire() -> ferny.Session:
+                return await pool.acquire(
+                    host,
+                    port=port,
+                    configfile='none',
+                    identity_file=os.path.join(key_dir, 'id_ed25519_passphrase'),
+                    login_name='admin',
+                    options=dict(userknownhostsfile=str(known_hosts)),
+                    interaction_responder=responder)
+
+            # concurrent users share a single connection
+            first, second = await asyncio.gather(acquire(), acquire())
+            assert first is second
+            assert len(MockResponder.askpass_args) == 1
+
+            # ...which stays up until the last user releases it
+            await pool.release(first)
+            wrapped = second.wrap_subprocess_args(['echo', 'remotecmd'])
+            proc = await asyncio.create_subprocess_exec(*wrapped, stdout=asyncio.subprocess.PIPE)
+            stdout, _stderr = await proc.communicate()
+            assert stdout == b'remotecmd\n'
+            await pool.release(second)
+
+            # then the next user gets a fresh connection
+            third = await acquire()
+            assert third is not first
+            assert len(MockResponder.askpass_args) == 2
+
+            # if the connection dies, the next user gets a new one, too
+            third.exit()
+            await third.wait()
+            assert not third.is_running()
+            fourth = await acquire()
+            assert fourth is not third
+            assert fourth.is_running()
+            assert len(MockResponder.askpass_args) == 3
+            await pool.release(third)
+            await pool.release(fourth)
+            assert not fourth.is_running()
+
+            # nothing is kept around for keys which are no longer in use
+            assert pool._locks == {}
@@ -22,6 +22,7 @@ import select
 import signal
 import subprocess
 import sys
+import weakref
 from pathlib import Path
 
 import pytest
@@ -89,6 +90,11 @@ async def test_enoent() -> None:
     exc, = await protocol.called('connection_lost')
     assert isinstance(exc, FileNotFoundError)
     await protocol.no_calls()
+    # the exec task reports the failure by closing the transport, but it
+    # finishes normally: it doesn't get cancelled by that
+    assert isinstance(transport, ferny.FernyTransport)
+    assert transport._exec_task.done()
+    assert not transport._exec_task.cancelled()
 
 
 @pytest.mark.asyncio
@@ -136,6 +142,15 @@ async def test_immediate_close() -> None:
     await protocol.no_calls()
 
 
+@pytest.mark.asyncio
+async def test_weakref() -> None:
+    transport, protocol = ferny.FernyTransport.spawn(MockProtocol, ['true'])
+    assert weakref.ref(transport)() is transport
+    transport.close()
+    await protocol.called_with('connection_lost', None)
+    await protocol.no_calls()
+
+
 @pytest.mark.asyncio
 async def test_use_before_ready() -> None:
     transport, protocol = ferny.FernyTransport.spawn(MockProtocol, ['true'])